@@ -1,26 +1,31 @@
 import pysrt, glob, pypoem
 
-marvel_poem_factory = pypoem.PoemFactory("marvel.db", True)
-# load all the srt files
-lines = []
-for filename in glob.glob('marvel_subtitles/*.srt'):
-    subs = pysrt.open(filename, encoding='iso-8859-1')
-    lines += [sub.text for sub in subs]
-unsuccessful = marvel_poem_factory.insert_many(lines)
-print str(len(unsuccessful)) + "/" + str(len(lines)) + " failed to parse"
-
-
-# Since rhyming a word with itself is a lame excuse for a poem, we will do a
-# simple cute hack to increase the number of nice poems we have checking for
-# repeated words.
+# Since rhyming a word with itself is a lame excuse for a poem, we will ask
+# the factory to never end two lines with the same word. If it doesn't have
+# enough rhymes for that, we fall back to the simple cute hack of retrying a
+# few times and checking for repeated words, keeping the last try regardless.
 
 def good_poem(factory, pattern, syllables, title, author, retry=5):
+    try:
+        return factory.new_poem(pattern, syllables, title, author, distinct_last_words=True)
+    except pypoem.ResourceError:
+        pass
     poem = None
     for i in xrange(retry):
         poem = factory.new_poem(pattern, syllables, title, author)
-        last_words = [line.words[-1] for line in poem.lines]
+        last_words = [line.last_word for line in poem.lines]
         if len(last_words) == len(set(last_words)):
             return poem
     return poem
 
-print good_poem(marvel_poem_factory, "AABBA", {"A":[7,8], "B":[7,8]}, "A Marvel Limmerick", "Chris")
\ No newline at end of file
+if __name__ == '__main__':
+    marvel_poem_factory = pypoem.PoemFactory("marvel.db", True)
+    # load all the srt files
+    lines = []
+    for filename in glob.glob('marvel_subtitles/*.srt'):
+        subs = pysrt.open(filename, encoding='iso-8859-1')
+        lines += [sub.text for sub in subs]
+    unsuccessful = marvel_poem_factory.insert_many(lines)
+    print str(len(unsuccessful)) + "/" + str(len(lines)) + " failed to parse"
+
+    print good_poem(marvel_poem_factory, "AABBA", {"A":[7,8], "B":[7,8]}, "A Marvel Limmerick", "Chris")
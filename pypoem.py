@@ -1,5 +1,6 @@
-import nltk, sqlite3, re, random
+import nltk, sqlite3, re, random, multiprocessing, itertools
 from nltk.corpus import cmudict
+from collections import Counter
 
 class ResourceError(Exception):
     pass
@@ -8,13 +9,18 @@ class Line(object):
     '''
         content: string - The source content for this line
         is_valid: bool - Whether this line is valid
-        words: List<string> - The words found in the content
-        parsed: List<List<string>> - The parsed pronuncation of this line
+        words: List<string> - The words found in the content (just the last one for lines read back from the database)
+        parsed: List<List<string>> - The parsed pronuncation of this line (None for lines read back from the database)
         diagnostics: string - Why the line failed to parse ("Success" otherwise)
+        last_word: string - The word the line ends on
     '''
     
     regex = re.compile("[a-z]+(?:'[a-z]+)?")
-    pdict = cmudict.dict()
+    # the 39 ARPAbet phonemes CMUDICT uses (without stress), numbered from 1 so each fits in 6 bits
+    phoneme_ids = dict((phoneme, i + 1) for (i, phoneme) in enumerate(
+        ['AA', 'AE', 'AH', 'AO', 'AW', 'AY', 'B', 'CH', 'D', 'DH', 'EH', 'ER', 'EY',
+         'F', 'G', 'HH', 'IH', 'IY', 'JH', 'K', 'L', 'M', 'N', 'NG', 'OW', 'OY', 'P',
+         'R', 'S', 'SH', 'T', 'TH', 'UH', 'UW', 'V', 'W', 'Y', 'Z', 'ZH']))
     
     @staticmethod
     def verify_and_parse(content):
@@ -25,47 +31,179 @@ class Line(object):
             returns:
                 (is_valid: bool, words: List<string>, pronunciations: List<List<string>>, status: string) 
         '''
+        (is_valid, words, parsed, _, _, status) = Line._verify_and_count(content)
+        return (is_valid, words, parsed, status)
+    
+    @staticmethod
+    def _verify_and_count(content):
+        '''
+            Does the work of verify_and_parse, also adding up the syllables and taking the rhyme of the last
+            word in the same pass over the words
+            args:
+                content: string
+            returns:
+                (is_valid: bool, words: List<string>, pronunciations: List<List<string>>, syllable_count: int,
+                 rhyme: int, status: string)
+        '''
         # find all words in content
         words = Line.regex.findall(content.lower())
         if (len(words) == 0):
-            return (False, [], None, "No words found")
+            return (False, [], None, None, None, "No words found")
+        parsed = []
+        syllable_count = 0
         for word in words:
-            if not(word in Line.pdict):
-                return (False, words, None, "No pronunciation found for word '" + word + "'")
-        return (True, words, [Line.pdict[word][0] for word in words], "Valid")
+            info = _word_info(word)
+            if info is None:
+                return (False, words, None, None, None, "No pronunciation found for word '" + word + "'")
+            parsed.append(info[0])
+            syllable_count += info[1]
+        return (True, words, parsed, syllable_count, info[2], "Valid")
     
     @staticmethod
     def extract_rhyme_phoneme(pron):
         '''
             Given a pronuncation, returns a unique key that maps to all pronunciations that rhyme with the given
-            pronuncation.
+            pronuncation. The rhyming phonemes are packed 6 bits apiece into an integer, so the key is cheap
+            to store and to group lines by.
             args:
                 pron: List<string>
             returns:
-                key: string
-        '''
-        # find all the vowels and their indices
-        vowels = [(i,vow) for (i,vow) in enumerate(pron) if vow[-1].isnumeric()]
-        # if no vowels present, take the whole pronuncation
-        if (len(vowels) == 0):
-            return reduce(lambda x,y: x+y, pron)
-        # take the last vowel and return the concatenation of the vowel
-        # and all phonemes occuring after it seperated by spaces
-        # removing the stress indicator on the vowel
-        (i,_) = max(vowels, key=lambda x: x[0])
-        return reduce(lambda x,y: x + " " + y, [pron[i][:-1]] + pron[i+1:])
+                key: int
+        '''
+        # walk back from the end to find the last vowel (if no vowels present, take the whole pronuncation)
+        start = 0
+        for i in range(len(pron) - 1, -1, -1):
+            if pron[i][-1].isdigit():
+                start = i
+                break
+        # pack the vowel and all phonemes occuring after it, removing the stress indicator on the vowel.
+        # Only the last 10 phonemes fit in a 64 bit SQLite integer, no real rhyme is anywhere near that long
+        key = 0
+        shift = 0
+        for phoneme in pron[max(start, len(pron) - 10):]:
+            key |= Line.phoneme_ids[phoneme.rstrip('012')] << shift
+            shift += 6
+        return key
         
     
     def __init__(self, content):
         self.content = content.strip().replace('\n', ' ')
-        (self.is_valid, self.words, self.parsed, self.diagnostics) = Line.verify_and_parse(self.content)
+        (self.is_valid, self.words, self.parsed, syllable_count, rhyme, self.diagnostics) = \
+            Line._verify_and_count(self.content)
         if (self.is_valid):
-            self.syllable_count = sum([len([syl for syl in pron if syl[-1].isnumeric()]) for pron in self.parsed])
-            last_pron = self.parsed[-1]
-            self.rhyme = Line.extract_rhyme_phoneme(last_pron)
+            self.syllable_count = syllable_count
+            self.rhyme = rhyme
+            self.last_word = self.words[-1]
+    
+    @classmethod
+    def from_row(cls, content, syllable_count, rhyme, last_word):
+        '''
+            Recreates a valid line from its stored columns without parsing its content again
+            args:
+                content: string
+                syllable_count: int
+                rhyme: int
+                last_word: string
+            returns:
+                line: Line
+        '''
+        line = cls.__new__(cls)
+        line.content = content
+        line.is_valid = True
+        line.words = [last_word]
+        line.parsed = None
+        line.diagnostics = "Valid"
+        line.syllable_count = syllable_count
+        line.rhyme = rhyme
+        line.last_word = last_word
+        return line
     
     def to_sql_params(self):
-        return (self.content, self.syllable_count, self.rhyme,)        
+        return (self.content, self.syllable_count, self.rhyme, self.last_word,)        
+
+# CMUDICT is large, so it is only loaded once something actually needs a pronunciation
+_pdict = None
+
+def _get_pdict():
+    '''
+        Returns the CMUDICT pronunciation dictionary, loading it on first use
+        returns:
+            pdict: dict<string,List<List<string>>>
+    '''
+    global _pdict
+    if _pdict is None:
+        _pdict = cmudict.dict()
+    return _pdict
+
+# Subtitles repeat the same words over and over, so we only ever look up and
+# analyze each distinct word once.
+_word_info_cache = {}
+
+def _word_info(word):
+    '''
+        Given a lowercase word, returns its pronunciation along with its syllable count and rhyme key,
+        memoizing the result per word
+        args:
+            word: string
+        returns:
+            (pron: List<string>, syllables: int, rhyme: int), or None if the word is not in CMUDICT
+    '''
+    try:
+        return _word_info_cache[word]
+    except KeyError:
+        pass
+    prons = _get_pdict().get(word)
+    if prons is None:
+        info = None
+    else:
+        pron = prons[0]
+        info = (pron, sum(1 for syl in pron if syl[-1].isdigit()), Line.extract_rhyme_phoneme(pron))
+    _word_info_cache[word] = info
+    return info
+
+# Short subtitle lines ("What?", "Come on.") repeat verbatim too, so also remember the outcome per
+# line. The cache is simply emptied when it fills up so huge inputs can't grow it without bound.
+_line_info_cache = {}
+_LINE_INFO_CACHE_SIZE = 100000
+
+def _line_info(lowered):
+    '''
+        Given a lowercase line, returns the syllable count, rhyme key and last word Line._verify_and_count
+        finds for it, memoizing the result per line
+        args:
+            lowered: string
+        returns:
+            (syllable_count: int, rhyme: int, last_word: string), or None if the line has no words or a word
+            not in CMUDICT
+    '''
+    try:
+        return _line_info_cache[lowered]
+    except KeyError:
+        pass
+    (is_valid, words, _, syllable_count, rhyme, _) = Line._verify_and_count(lowered)
+    result = (syllable_count, rhyme, words[-1]) if is_valid else None
+    if len(_line_info_cache) >= _LINE_INFO_CACHE_SIZE:
+        _line_info_cache.clear()
+    _line_info_cache[lowered] = result
+    return result
+
+def _parse(resource):
+    '''
+        Parses a single resource for PoemFactory.insert_many. Lives at module level so it can be handed
+        to worker processes. Valid resources only come back as their SQL params, since building a Line
+        for every one of them is wasted work
+        args:
+            resource: string
+        returns:
+            (params: tuple, None) if the line is valid, (None, line: Line) otherwise
+    '''
+    # same normalization as Line, without keeping the words and pronunciations around
+    content = resource.strip().replace('\n', ' ')
+    line_info = _line_info(content.lower())
+    if line_info is None:
+        # the caller wants the diagnostics of failed lines, so let Line work them out
+        return (None, Line(resource))
+    return ((content,) + line_info, None)
 
 class Poem(object):
     
@@ -85,13 +223,16 @@ class Poem(object):
         '''
             Override default string converter
         '''
-        line_string = reduce(lambda x,y: x + y, map(lambda line: line.content + "\n", self.lines))
+        line_string = "".join(line.content + "\n" for line in self.lines)
         author_string = "-- " + self.author
         title_string = self.title + '\n'
         sep_string = len(self.title)*"_" + '\n\n'
         return title_string + sep_string + line_string + sep_string + author_string
 
 class PoemFactory(object):
+    # how many rows insert_many commits at a time
+    _insert_chunk_size = 10000
+    
     def __init__(self, database_path, new=False):
         '''
             Initializes a new PoemFactory
@@ -100,6 +241,18 @@ class PoemFactory(object):
                 new: bool
         '''
         self.conn = sqlite3.connect(database_path)
+        # lines are bulk loaded once and then only read, so trade some durability for fewer fsyncs
+        c = self.conn.cursor()
+        c.execute('''PRAGMA journal_mode=WAL;''')
+        c.execute('''PRAGMA synchronous=NORMAL;''')
+        c.execute('''PRAGMA temp_store=MEMORY;''')
+        c.execute('''PRAGMA cache_size=-65536;''')
+        # reused by every new_poem call
+        self._cursor = c
+        # rhyme -> syllable_count -> last word -> ids of matching lines, built from the database on demand
+        self._by_rhyme = None
+        # (syllable range, line count, distinct_last_words) -> rhymes that can fill such a pattern group
+        self._eligible_rhymes = {}
         if (new):
             self.reset_database()
         
@@ -112,39 +265,159 @@ class PoemFactory(object):
         c.execute('''CREATE TABLE line (id INTEGER PRIMARY KEY,
                                         raw_text TEXT NOT NULL,
                                         syllable_count INTEGER NOT NULL,
-                                        rhyme TEXT);''')
+                                        rhyme INTEGER,
+                                        last_word TEXT NOT NULL);''')
         self.conn.commit()
+        self._by_rhyme = None
     
-    def insert_many(self, resources):
+    def _warm_index(self):
+        '''
+            Loads the rhyme and syllable count of every line into memory so new_poem can pick lines
+            without querying the database
+            returns:
+                by_rhyme: dict<int,dict<int,dict<string,list<int>>>> - rhyme -> syllable_count -> last word -> line ids
+        '''
+        by_rhyme = {}
+        c = self.conn.cursor()
+        c.execute('''SELECT id, syllable_count, rhyme, last_word FROM line''')
+        for (line_id, syllable_count, rhyme, last_word) in c:
+            by_rhyme.setdefault(rhyme, {}).setdefault(syllable_count, {}).setdefault(last_word, []).append(line_id)
+        self._by_rhyme = by_rhyme
+        self._eligible_rhymes = {}
+        return by_rhyme
+    
+    def insert_many(self, resources, processes=1):
         '''
             Updates the current database with new resources
             args:
                 resources: list<string>
+                processes: int - How many worker processes parse the resources (by default they are parsed
+                                 in this process). Scripts asking for more than one need an
+                                 `if __name__ == '__main__':` guard, since on Windows and macOS every worker
+                                 re-imports the main script
             returns:
                 num_failed: int
         '''
-        n = 0
-        new_lines = []
+        pool = None
+        if (processes > 1):
+            # parsing is pure CPU work, so spread it over worker processes. Load CMUDICT first so
+            # forked workers inherit it rather than each loading their own copy
+            _get_pdict()
+            pool = multiprocessing.Pool(processes)
+            parsed = pool.imap(_parse, resources, chunksize=512)
+        else:
+            parsed = (_parse(resource) for resource in resources)
         unsuccessful_lines= []
-        for resource in resources:
-            line = Line(resource)
-            if not(line.is_valid):
-                unsuccessful_lines.append(line)
-            else:
-                new_lines.append(line)
-        # insert many into our database
+        def valid_params():
+            # stream the valid lines into the inserts instead of holding them all in memory
+            for (params, line) in parsed:
+                if (params is None):
+                    unsuccessful_lines.append(line)
+                else:
+                    yield params
         c = self.conn.cursor()
-        c.executemany('''INSERT INTO line (raw_text, syllable_count, rhyme) VALUES (?,?,?)''',
-                      [line.to_sql_params() for line in new_lines])
-        self.conn.commit()
+        busy_timeout = c.execute('''PRAGMA busy_timeout;''').fetchone()[0]
+        try:
+            # hold on to the database lock for the whole load instead of taking it for every transaction.
+            # If another connection has the database open we can't, so find out right away rather than
+            # after the busy timeout and load it with normal locking instead
+            c.execute('''PRAGMA busy_timeout=0;''')
+            c.execute('''PRAGMA locking_mode=EXCLUSIVE;''')
+            try:
+                c.execute('''BEGIN IMMEDIATE;''')
+                self.conn.commit()
+            except sqlite3.OperationalError:
+                self._unlock(c)
+            c.execute('''PRAGMA busy_timeout=%d;''' % busy_timeout)
+            rows = valid_params()
+            while True:
+                # commit in chunks so a huge load doesn't pile up in one enormous transaction
+                chunk = list(itertools.islice(rows, PoemFactory._insert_chunk_size))
+                if not(chunk):
+                    break
+                with self.conn:
+                    c.executemany('''INSERT INTO line (raw_text, syllable_count, rhyme, last_word) VALUES (?,?,?,?)''',
+                                  chunk)
+        finally:
+            if (pool is not None):
+                pool.terminate()
+                pool.join()
+            self._unlock(c)
+            c.execute('''PRAGMA busy_timeout=%d;''' % busy_timeout)
+            # the in-memory index no longer matches the database
+            self._by_rhyme = None
         return unsuccessful_lines
     
-    def new_poem(self, pattern, syllable_ranges, title="Untitled", author="Anonymous"):
+    def _unlock(self, c):
+        '''
+            Goes back to normal locking, giving up the exclusive lock insert_many may hold
+            args:
+                c: sqlite3.Cursor
+        '''
+        c.execute('''PRAGMA locking_mode=NORMAL;''')
+        # the exclusive lock is only given up the next time the database is read
+        c.execute('''SELECT 1 FROM sqlite_master LIMIT 1;''')
+    
+    @staticmethod
+    def _count_resources(by_syllables, syllable_range, distinct_last_words):
+        '''
+            Counts how many lines (or distinct last words) of a rhyme group fall in a syllable range
+            args:
+                by_syllables: dict<int,dict<string,list<int>>>
+                syllable_range: set<int>
+                distinct_last_words: bool
+            returns:
+                count: int
+        '''
+        if (distinct_last_words):
+            return len(set(last_word for syllables in syllable_range
+                           for last_word in by_syllables.get(syllables, ())))
+        return sum(len(line_ids) for syllables in syllable_range
+                   for line_ids in by_syllables.get(syllables, {}).values())
+    
+    @staticmethod
+    def _assign_distinct_rhymes(possible_resources):
+        '''
+            Randomly gives every pattern group its own rhyme out of the ones that can fill it. The groups with
+            the fewest rhymes to choose from choose first, backtracking whenever one of them runs out of choices
+            args:
+                possible_resources: dict<string,list<int>>
+            returns:
+                rhymes: dict<string,int>, or None if the groups can't all get different rhymes
+        '''
+        groups = sorted(possible_resources, key=lambda p: len(possible_resources[p]))
+        rhymes = {}
+        used_rhymes = set()
+        def assign(i):
+            if (i == len(groups)):
+                return True
+            p = groups[i]
+            if (len(possible_resources[p]) >= len(groups)):
+                # there are more rhymes than groups could ever take from this one (or any after it), so a
+                # free rhyme always exists and just picking at random until we hit one can't fail
+                rhyme = random.choice(possible_resources[p])
+                while (rhyme in used_rhymes):
+                    rhyme = random.choice(possible_resources[p])
+                candidates = [rhyme]
+            else:
+                candidates = random.sample(possible_resources[p], len(possible_resources[p]))
+            for rhyme in candidates:
+                if not(rhyme in used_rhymes):
+                    used_rhymes.add(rhyme)
+                    rhymes[p] = rhyme
+                    if (assign(i + 1)):
+                        return True
+                    used_rhymes.remove(rhyme)
+            return False
+        return rhymes if assign(0) else None
+    
+    def new_poem(self, pattern, syllable_ranges, title="Untitled", author="Anonymous", distinct_last_words=False):
         '''
             Creates a new poem using the current database following certain constraints
             args:
                 pattern: string
                 syllable_ranges: dict<string,list<int>>
+                distinct_last_words: bool - Never end two lines of the poem with the same word
             returns:
                 poem: Poem
         '''
@@ -152,64 +425,80 @@ class PoemFactory(object):
         if (len(pattern) == 0):
             raise ValueError("Empty pattern")
             
+        # Count the number of lines per pattern category
+        pattern_counts = Counter(pattern)
+        pattern_domain = set(pattern_counts)
+        
         # Check for valid syllable ranges
-        pattern_domain = set(pattern)
+        missing = pattern_domain - set(syllable_ranges)
+        if missing:
+            raise ValueError("Pattern " + missing.pop() + " does not exist in syllable_ranges")
         for p in pattern_domain:
-            if not(p in syllable_ranges):
-                raise ValueError("Pattern " + p + " does not exist in syllable_ranges")
             if len(syllable_ranges[p]) == 0:
                 raise ValueError("Empty syllable_ranges entry for " + p)
         
-        # Count the number of lines per pattern category
-        pattern_counts = dict.fromkeys(pattern_domain, 0)
-        for p in pattern:
-            pattern_counts[p] += 1
-        
         # Attempt to find lines for each pattern category
-        c = self.conn.cursor()
+        by_rhyme = self._by_rhyme
+        if (by_rhyme is None):
+            by_rhyme = self._warm_index()
         
-        # Assign possible resources for each pattern group
+        # For each pattern group, find the rhyme groups that can fill its requirements
         possible_resources = {}
         for p in pattern_domain:
             requested_count = pattern_counts[p]
-            requested_syllable_range = syllable_ranges[p]
-            # group 
-            c.execute('''
-                SELECT rhyme FROM
-                    (SELECT l.rhyme, count(id) as num_resources
-                     FROM line l
-                     WHERE l.syllable_count in (%s)
-                     GROUP BY l.rhyme)
-                WHERE num_resources >= (?)
-                ''' % ','.join('?'*len(requested_syllable_range)),
-                      list(requested_syllable_range) + [requested_count])
-            results = c.fetchall() # results: list[(string)]
-            if not(results):
+            requested_syllable_range = set(syllable_ranges[p])
+            # the same few syllable ranges get asked for over and over, so only scan the rhymes once for each
+            key = (tuple(sorted(requested_syllable_range)), requested_count, distinct_last_words)
+            rhymes = self._eligible_rhymes.get(key)
+            if (rhymes is None):
+                rhymes = [rhyme for (rhyme, by_syllables) in by_rhyme.items()
+                          if PoemFactory._count_resources(by_syllables, requested_syllable_range,
+                                                          distinct_last_words) >= requested_count]
+                self._eligible_rhymes[key] = rhymes
+            if not(rhymes):
                 raise ResourceError(p)
-            possible_resources[p] = [result[0] for result in results]
-
-        # Now that each pattern group has a set of resources that can fill its requirements
-        # we need to assign each resource to each pattern. If we want to eliminate collisions
-        # we will have to do some smart assigning here, but since this is just a tutorial
+            possible_resources[p] = rhymes
+        
+        # Pick a random rhyme group for each pattern group and sample its lines. Unless distinct_last_words
+        # is set, we don't do any smart assigning to eliminate collisions, since this is just a tutorial
         # and I'm lazy AF lets just assume our db is large enough that collisions are very unlikely
-        assigned_resources = {}
-        for p in pattern_domain:
+        if (distinct_last_words):
+            # lines with the same last word always share a rhyme, so giving every pattern group its
+            # own rhyme keeps last words from repeating across groups
+            rhymes = PoemFactory._assign_distinct_rhymes(possible_resources)
+            if (rhymes is None):
+                raise ResourceError("".join(sorted(pattern_domain)))
+        else:
             # we will introduce randomness here so we don't get same poem over and over again
-            resource_group = random.choice(possible_resources[p])
+            rhymes = dict((p, random.choice(possible_resources[p])) for p in pattern_domain)
+        assigned_ids = {}
+        for p in pattern_domain:
             requested_count = pattern_counts[p]
-            requested_syllable_range = syllable_ranges[p]
-            c.execute('''
-                SELECT raw_text
-                FROM line l
-                WHERE l.syllable_count in (%s) AND l.rhyme = (?)
-                ORDER BY RANDOM()
-                LIMIT (?)
-            ''' % ','.join('?'*len(requested_syllable_range)),
-                      list(requested_syllable_range) + [resource_group, requested_count])
-            assigned_resources[p] = [line[0] for line in c.fetchall()]
+            rhyme = rhymes[p]
+            by_last_word = {}
+            for syllables in set(syllable_ranges[p]):
+                for (last_word, line_ids) in by_rhyme[rhyme].get(syllables, {}).items():
+                    by_last_word.setdefault(last_word, []).extend(line_ids)
+            if (distinct_last_words):
+                assigned_ids[p] = [random.choice(by_last_word[last_word])
+                                   for last_word in random.sample(list(by_last_word), requested_count)]
+            else:
+                candidate_ids = [line_id for line_ids in by_last_word.values() for line_id in line_ids]
+                assigned_ids[p] = random.sample(candidate_ids, requested_count)
+        
+        c = self._cursor
+        # fetch the stored columns of every chosen line at once
+        chosen_ids = [i for ids in assigned_ids.values() for i in ids]
+        c.execute('''
+            SELECT id, raw_text, syllable_count, rhyme, last_word
+            FROM line l
+            WHERE l.id in (%s)
+            ''' % ','.join('?'*len(chosen_ids)),
+                  chosen_ids)
+        rows = dict((row[0], row[1:]) for row in c.fetchall())
         
         lines = []
         for p in pattern:
-            lines.append(Line(assigned_resources[p].pop()))
+            lines.append(Line.from_row(*rows[assigned_ids[p].pop()]))
         
         return Poem(lines, title, author)
\ No newline at end of file